@@ -1,14 +1,16 @@
 # rag-pdf/prepare_index.py
 import json, re, numpy as np
 from pathlib import Path
-from sentence_transformers import SentenceTransformer
+from search_catalog import binarize, build_model, quantize_i8
 
 SRC_JSON = Path("../kellen_produkte.json").resolve()
 DOCS_JSON = Path("catalog_docs.json")
 VECS_NPY  = Path("catalog_vectors.npy")
+BIN_NPY   = Path("catalog_vectors_bin.npy")
+_ID_RE    = re.compile(r"[^0-9a-z]+")
 
 def norm_id(s: str) -> str:
-    return re.sub(r"[^0-9a-z]+", "", (s or "").lower())
+    return _ID_RE.sub("", (s or "").lower())
 
 def build_docs():
     data = json.loads(Path(SRC_JSON).read_text(encoding="utf-8"))
@@ -47,11 +49,13 @@ def main():
     print("📦 Lade Produkte aus:", SRC_JSON)
     docs = build_docs()
     print(f"🧠 Erzeuge Vektoren für {len(docs)} Varianten …")
-    model = SentenceTransformer("paraphrase-multilingual-MiniLM-L12-v2")
-    vecs = model.encode([d["text"] for d in docs], normalize_embeddings=True, show_progress_bar=True)
-    np.save(VECS_NPY, vecs)
+    model = build_model()
+    vecs = model.encode([d["text"] for d in docs], batch_size=256, normalize_embeddings=True,
+                        show_progress_bar=True).astype(np.float32)
+    np.save(VECS_NPY, quantize_i8(vecs))
+    np.save(BIN_NPY, binarize(vecs))  # sign bits for the Hamming pre-rank
     DOCS_JSON.write_text(json.dumps(docs, ensure_ascii=False, indent=2), encoding="utf-8")
-    print(f"✅ Fertig: {DOCS_JSON.name} + {VECS_NPY.name}")
+    print(f"✅ Fertig: {DOCS_JSON.name} + {VECS_NPY.name} + {BIN_NPY.name}")
 
 if __name__ == "__main__":
     main()
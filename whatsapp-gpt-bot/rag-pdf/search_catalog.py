@@ -2,23 +2,40 @@ import json
 import re
 import unicodedata
 import argparse
+import functools
+import itertools
+import os
+import pickle
 import numpy as np
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict, Any
-from sentence_transformers import SentenceTransformer, util
-from rapidfuzz import process, fuzz
+try:
+    import simsimd
+except ImportError:  # optional SIMD kernels; fall back to a NumPy gemv
+    simsimd = None
+from rapidfuzz import process, fuzz, utils
 
 CATALOG_JSON = "kellen_produkte.json"
 DOCS_JSON = "catalog_docs.json"
+DOCS_PKL = "catalog_docs.pkl"  # DOCS_JSON + prebuilt prefilter structures, for fast cold starts
+SIDECAR_VERSION = 1  # bump whenever _postings() or a _build_*_index() changes its output
 VECTORS_NPY = "catalog_vectors.npy"
+VECTORS_BIN_NPY = "catalog_vectors_bin.npy"  # 1 bit/dim sign copy for the Hamming pre-rank
 EMBED_MODEL = "paraphrase-multilingual-MiniLM-L12-v2"
+I8_SCALE = 127  # embeddings are unit-normalized, so one global scale is enough
+HAMMING_CANDIDATES = 200  # rows re-ranked with int8 cosine after the Hamming pass
+HAMMING_MIN_ROWS = 4096   # below this a full int8 scan is cheap and loses no recall
+PARALLEL_MIN_PRODUCTS = 2000  # smaller catalogs flatten faster than a pool starts
+
+# one pass: any run of whitespace and/or disallowed chars becomes a single space
+_NON_RE = re.compile(r"[^a-z0-9äöüß\.-]+")  # keep hyphen for readability
+_DIG_RE = re.compile(r"\D")
 
 def normalize_text(s: str) -> str:
     if not s:
         return ""
-    s = s.lower()
-    s = unicodedata.normalize("NFKD", s)
-    s = re.sub(r"[^a-z0-9äöüß\.\s-]", " ", s)  # keep hyphen for readability
-    s = re.sub(r"\s+", " ", s).strip()
+    s = _NON_RE.sub(" ", unicodedata.normalize("NFKD", s.lower())).strip()
     return s.replace("-", " ")  # treat hyphen as space for matching
 
 def split_words(s: str):
@@ -28,7 +45,13 @@ def norm_bestell(s: str) -> str:
     return s.replace(" ", "").strip() if s else ""
 
 def digits_only(s: str) -> str:
-    return re.sub(r"\D", "", s or "")
+    return _DIG_RE.sub("", s or "")
+
+def quantize_i8(vecs: np.ndarray) -> np.ndarray:
+    return np.clip(np.round(vecs * I8_SCALE), -128, 127).astype(np.int8)
+
+def binarize(vecs: np.ndarray) -> np.ndarray:
+    return np.packbits(np.asarray(vecs) > 0, axis=-1)
 
 def _to_float(x):
     if x in (None, "", "-"):
@@ -105,74 +128,277 @@ def flatten_products(data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
             rows.append(row)
     return rows
 
+def flatten_products_parallel(data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """flatten_products() fanned out over all cores; row order is preserved."""
+    workers = os.cpu_count() or 1
+    if workers == 1 or len(data) < PARALLEL_MIN_PRODUCTS:
+        return flatten_products(data)
+    size = -(-len(data) // workers)
+    chunks = [data[i:i + size] for i in range(0, len(data), size)]
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        return list(itertools.chain.from_iterable(ex.map(flatten_products, chunks)))
+
+def build_model():
+    """Embedding model for index builds (here and in prepare_index.py): fp16
+    on CUDA/MPS when available."""
+    import torch  # pulled in by sentence-transformers anyway
+    from sentence_transformers import SentenceTransformer
+    if torch.cuda.is_available():
+        return SentenceTransformer(EMBED_MODEL, device="cuda").half()
+    if torch.backends.mps.is_available():
+        return SentenceTransformer(EMBED_MODEL, device="mps").half()
+    return SentenceTransformer(EMBED_MODEL, device="cpu")
+
 def build_index():
     with open(CATALOG_JSON, "r", encoding="utf-8") as f:
         data = json.load(f)
-    docs = flatten_products(data)
-    model = SentenceTransformer(EMBED_MODEL)
-    texts = [d["_blob"] for d in docs]
-    vectors = model.encode(texts, convert_to_numpy=True, show_progress_bar=True)
+    docs = flatten_products_parallel(data)
+    model = build_model()
+    # variants that differ only by Bestell-Nr./price share a blob: encode each once
+    texts, inverse = _distinct([d["_blob"] for d in docs])
+    vectors = model.encode(texts, batch_size=256, convert_to_numpy=True,
+                           normalize_embeddings=True, show_progress_bar=True).astype(np.float32)
+    vectors = vectors[inverse]
     with open(DOCS_JSON, "w", encoding="utf-8") as f:
         json.dump(docs, f, ensure_ascii=False, indent=2)
-    np.save(VECTORS_NPY, vectors)
+    _write_sidecar(docs)
+    # .npy pads its header to 64 bytes and a 384-dim int8 row is 6 cache
+    # lines, so every row of the mmap starts cache-line aligned
+    np.save(VECTORS_NPY, quantize_i8(vectors))
+    np.save(VECTORS_BIN_NPY, binarize(vectors))
+    for loader in (_load, _stage_index, _load_semantic, _load_bin_vectors):
+        loader.cache_clear()
     print(f"✅ Index built with {len(docs)} products")
 
 # -------- name-first helpers --------
 
-def title_prefilter(docs, norm_q: str):
+def _postings(texts):
+    """Token posting lists in CSR form: token -> row id, plus flat doc ids and
+    row offsets, so a query's lists can be gathered with array ops."""
+    vocab: Dict[str, int] = {}
+    rows: List[List[int]] = []
+    for i, t in enumerate(texts):
+        for tok in set(split_words(t)):
+            if tok not in vocab:
+                vocab[tok] = len(rows)
+                rows.append([])
+            rows[vocab[tok]].append(i)
+    off = np.zeros(len(rows) + 1, dtype=np.int64)
+    off[1:] = np.cumsum([len(r) for r in rows])
+    flat = np.fromiter((i for r in rows for i in r), dtype=np.int32, count=off[-1])
+    return vocab, flat, off
+
+def _gather(flat: np.ndarray, off: np.ndarray, rows) -> np.ndarray:
+    """Concatenated doc ids of the given posting rows."""
+    rows = np.asarray(rows, dtype=np.int64)
+    lens = off[rows + 1] - off[rows]
+    shift = np.repeat(off[rows] - np.cumsum(lens) + lens, lens)
+    return flat[shift + np.arange(lens.sum())]
+
+def _ranked(index, scores: np.ndarray, top_k: int):
+    """Top-k docs with a non-zero score, best first; ties keep catalog order."""
+    ids = np.flatnonzero(scores)
+    if len(ids) > top_k:
+        # partial select: keep everything scoring at least the k-th best (so
+        # boundary ties still resolve by catalog order), sort only those
+        neg = -scores[ids]
+        ids = ids[neg <= np.partition(neg, top_k - 1)[top_k - 1]]
+    ids = ids[np.argsort(-scores[ids], kind="stable")][:top_k]
+    docs = index["docs"]
+    return [docs[i] for i in ids]
+
+def title_prefilter(index, norm_q: str, top_k: int):
     """Prioritize matches where the query fits the TITLE specifically."""
     q_tokens = split_words(norm_q)
     if not q_tokens: return []
-    out = []
-    for d in docs:
-        t = d["_title_norm"]
-        # substring hit (very strong)
-        if norm_q and (norm_q in t or t in norm_q):
-            out.append((1.0, d))
-            continue
-        # token recall just on title tokens
-        t_tokens = set(split_words(t))
-        hits = sum(1 for tok in q_tokens if tok in t_tokens)
-        if hits == 0: continue
-        recall = hits / len(q_tokens)
-        if recall >= 0.6:
-            out.append((recall, d))
-    out.sort(key=lambda x: -x[0])
-    return [d for _, d in out]
-
-def prefilter_literal(docs, norm_q: str):
+    # token recall just on title tokens: one gather over the posting lists,
+    # one bincount weighted by how often each token appears in the query
+    tix = _stage_index("title")
+    vocab, flat, off = tix["postings"]
+    pairs = [(vocab[tok], n) for tok, n in Counter(q_tokens).items() if tok in vocab]
+    rows = np.array([r for r, _ in pairs], dtype=np.int64)
+    weights = np.repeat([n for _, n in pairs], off[rows + 1] - off[rows])
+    hits = np.bincount(_gather(flat, off, rows), weights=weights, minlength=len(index["docs"]))
+    recall = hits / len(q_tokens)
+    scores = np.where(recall >= 0.6, recall, 0.0)
+    # substring hit (very strong); titles repeat across variants, so test each once
+    uniq = tix["uniq"]
+    sub = np.fromiter((norm_q in t or t in norm_q for t in uniq), dtype=bool, count=len(uniq))
+    scores[sub[tix["inv"]]] = 1.0
+    return _ranked(index, scores, top_k)
+
+def prefilter_literal(index, norm_q: str, top_k: int):
     """Literal recall on the full blob (kept strict)."""
     q_tokens = split_words(norm_q)
     if not q_tokens: return []
-    scored = []
-    for d in docs:
-        blob = d["_blob"]
-        hits = sum(1 for t in q_tokens if t in blob)
-        if hits == 0: continue
-        recall = hits / len(q_tokens)
-        if recall >= 0.6:
-            scored.append((recall, hits, d))
-    scored.sort(key=lambda x: (-x[0], -x[1]))
-    return [d for _,__, d in scored]
-
-def fuzzy_multi(docs, norm_q: str, limit: int):
+    # a query token has no whitespace, so a substring hit in the blob always
+    # lies inside one blob word: find it in the newline-joined vocabulary
+    # (one C-level scan) and map match offsets back to words
+    bix = _stage_index("blob")
+    _, flat, off = bix["postings"]
+    starts, text = bix["vocab_starts"], bix["vocab_text"]
+    ids, weights = [], []
+    for tok, n in Counter(q_tokens).items():
+        pos = [m.start() for m in re.finditer(re.escape(tok), text)]
+        if not pos: continue
+        words = np.searchsorted(starts, pos, side="right") - 1
+        # a doc counts once per token; a mask instead of np.unique, whose first
+        # call imports numpy.ma (~15 ms on the one-process-per-query path)
+        found = np.zeros(len(index["docs"]), dtype=bool)
+        found[_gather(flat, off, words)] = True
+        docs_hit = np.flatnonzero(found)
+        ids.append(docs_hit)
+        weights.append(np.full(len(docs_hit), n))
+    if not ids: return []
+    hits = np.bincount(np.concatenate(ids), weights=np.concatenate(weights), minlength=len(index["docs"]))
+    return _ranked(index, np.where(hits / len(q_tokens) >= 0.6, hits, 0), top_k)
+
+def fuzzy_multi(index, norm_q: str, limit: int):
     """Fuzzy across title + ausfuehrung + category."""
-    keys = [f"{d['title']} {d.get('ausfuehrung','')} {d.get('category','')}".strip() for d in docs]
-    res = process.extract(norm_q, keys, scorer=fuzz.token_set_ratio, limit=limit)
-    out, seen = [], set()
-    for _, score, idx in res:
-        if score < 68:  # a little more forgiving
-            continue
-        if idx in seen: continue
-        seen.add(idx)
-        out.append(docs[idx])
-    return out
+    q = utils.default_process(norm_q)
+    # score each distinct key once, then fan out to its variants; scores below
+    # the cutoff come back as 0 (a little more forgiving than 70)
+    fix = _stage_index("fuzzy")
+    scores = process.cdist([q], fix["uniq"], scorer=fuzz.token_set_ratio,
+                           workers=-1, score_cutoff=68)[0]
+    return _ranked(index, scores[fix["inv"]], limit)
+
+def _read_sidecar():
+    # the JSON stays the source of truth (the bot reads it too); the pickle is
+    # only used while it is at least as new, e.g. not after a hand-edited JSON,
+    # or when it is all there is
+    if not os.path.exists(DOCS_PKL):
+        return None
+    if os.path.exists(DOCS_JSON) and os.path.getmtime(DOCS_PKL) < os.path.getmtime(DOCS_JSON):
+        return None
+    with open(DOCS_PKL, "rb") as f:
+        sidecar = pickle.load(f)
+    # a sidecar written by other code (older list format, or structures from
+    # before a builder change) must not be served; the caller rewrites it
+    if not isinstance(sidecar, dict) or sidecar.get("version") != SIDECAR_VERSION:
+        return None
+    return sidecar
+
+def _write_sidecar(docs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Pickle docs plus every stage's prefilter structures next to DOCS_JSON.
+
+    The bot starts one process per query, so these are built once here
+    instead of on every search.
+    """
+    sidecar = {
+        "version": SIDECAR_VERSION, "docs": docs,
+        **{name: build(docs) for name, build in _STAGE_BUILDERS.items()},
+    }
+    tmp = f"{DOCS_PKL}.{os.getpid()}.tmp"  # concurrent queries may race to write it
+    with open(tmp, "wb") as f:
+        pickle.dump(sidecar, f, protocol=5)
+    os.replace(tmp, DOCS_PKL)
+    return sidecar
+
+@functools.lru_cache(maxsize=1)
+def _load():
+    """Docs and the Bestell-Nr. lookups, once per process.
+
+    The bot spawns one process per query, so this stays minimal: whatever the
+    later stages need comes from _stage_index(), only once a stage runs.
+    """
+    sidecar = _read_sidecar()
+    if sidecar is None:
+        with open(DOCS_JSON, "r", encoding="utf-8") as f:
+            docs = json.load(f)
+        try:  # pay the build once, so the next query process can skip it
+            sidecar = _write_sidecar(docs)
+        except OSError:
+            sidecar = {"docs": docs}
+    prebuilt = dict(sidecar)
+    prebuilt.pop("version", None)
+    docs = prebuilt.pop("docs")
+    # Bestell-Nr. lookups; setdefault keeps the first doc on duplicates
+    by_bestell, by_digits = {}, {}
+    for d in docs:
+        by_bestell.setdefault(d["bestell_nr"].strip().lower(), d)
+        if d["_bestell_digits"]:
+            by_digits.setdefault(d["_bestell_digits"], d)
+    return {"docs": docs, "by_bestell": by_bestell, "by_digits": by_digits, "prebuilt": prebuilt}
+
+def _distinct(keys: List[str]):
+    """Distinct keys (first-seen order) and each key's position among them.
+
+    Plain dicts rather than np.unique, whose first call imports numpy.ma
+    (~15 ms) when the structures are built per query process.
+    """
+    pos: Dict[str, int] = {}
+    inv = np.fromiter((pos.setdefault(k, len(pos)) for k in keys), dtype=np.int64, count=len(keys))
+    return list(pos), inv
+
+def _build_title_index(docs):
+    """Title postings plus distinct titles, for step 3 (title_prefilter)."""
+    titles = [d["_title_norm"] for d in docs]
+    uniq, inv = _distinct(titles)
+    return {"postings": _postings(titles), "uniq": uniq, "inv": inv}
+
+def _build_blob_index(docs):
+    """Blob postings and the joined vocabulary, for step 4 (prefilter_literal)."""
+    postings = _postings([d["_blob"] for d in docs])
+    vocab = list(postings[0])  # row ids follow insertion order
+    return {
+        "postings": postings,
+        "vocab_text": "\n".join(vocab),
+        "vocab_starts": np.cumsum([0] + [len(w) + 1 for w in vocab[:-1]]),
+    }
+
+def _build_fuzzy_index(docs):
+    """Distinct preprocessed fuzzy keys, for step 5 (fuzzy_multi)."""
+    # preprocessed once so cdist() does not redo it for every query; variants
+    # often share title/ausfuehrung/category, so keep only the distinct keys
+    keys = [
+        utils.default_process(f"{d['title']} {d.get('ausfuehrung','')} {d.get('category','')}")
+        for d in docs
+    ]
+    uniq, inv = _distinct(keys)
+    return {"uniq": uniq, "inv": inv}
+
+_STAGE_BUILDERS = {
+    "title": _build_title_index,
+    "blob": _build_blob_index,
+    "fuzzy": _build_fuzzy_index,
+}
+
+@functools.lru_cache(maxsize=None)
+def _stage_index(name: str):
+    """Prefilter structures for one search stage: from the sidecar when it
+    has them, otherwise built on first use."""
+    index = _load()
+    if name in index["prebuilt"]:
+        return index["prebuilt"][name]
+    return _STAGE_BUILDERS[name](index["docs"])
+
+@functools.lru_cache(maxsize=1)
+def _load_semantic():
+    """Int8 vectors and embedding model, only needed by the semantic fallback.
+
+    Kept apart from _load() so Bestell-Nr./title hits never pay for importing
+    torch or loading the model.
+    """
+    from sentence_transformers import SentenceTransformer
+    vectors = np.load(VECTORS_NPY, mmap_mode="r")  # zero-copy, paged in on demand
+    if vectors.dtype != np.int8:  # float index from an older build
+        vectors = quantize_i8(vectors / np.linalg.norm(vectors, axis=1, keepdims=True))
+    if simsimd is None:  # NumPy fallback multiplies in float32: convert once, not per query
+        vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors, SentenceTransformer(EMBED_MODEL)
+
+@functools.lru_cache(maxsize=1)
+def _load_bin_vectors():
+    """Packed sign bits for the Hamming pre-rank; only loaded once a catalog
+    is large enough for search() to use it."""
+    if os.path.exists(VECTORS_BIN_NPY):
+        return np.load(VECTORS_BIN_NPY, mmap_mode="r")
+    return binarize(_load_semantic()[0])  # index built before the binary copy existed
 
 def search(query: str, top_k=25, bestell_only: bool=False):
-    with open(DOCS_JSON, "r", encoding="utf-8") as f:
-        docs = json.load(f)
-    vectors = np.load(VECTORS_NPY)
-    model = SentenceTransformer(EMBED_MODEL)
+    index = _load()
+    docs = index["docs"]
 
     raw_q = query or ""
     norm_q = normalize_text(raw_q)
@@ -182,40 +408,59 @@ def search(query: str, top_k=25, bestell_only: bool=False):
         return []
 
     # 1) exact Bestell-Nr.
-    for d in docs:
-        if d["bestell_nr"].strip().lower() == raw_q.strip().lower():
-            return [d]
+    hit = index["by_bestell"].get(raw_q.strip().lower())
+    if hit is not None:
+        return [hit]
 
     # 2) digits-only Bestell-Nr.
     q_digits = digits_only(raw_q)
-    if q_digits:
-        for d in docs:
-            if d["_bestell_digits"] == q_digits:
-                return [d]
+    if q_digits and q_digits in index["by_digits"]:
+        return [index["by_digits"][q_digits]]
 
     # Bestell-only mode stops here
     if bestell_only:
         return []
 
     # 3) TITLE-FIRST (fixes “Ersatz-Belag”, etc.)
-    t_hits = title_prefilter(docs, norm_q)
+    t_hits = title_prefilter(index, norm_q, top_k)
     if t_hits:
-        return t_hits[:top_k]
+        return t_hits
 
     # 4) literal blob
-    lit = prefilter_literal(docs, norm_q)
+    lit = prefilter_literal(index, norm_q, top_k)
     if lit:
-        return lit[:top_k]
+        return lit
 
     # 5) fuzzy
-    fuzzy = fuzzy_multi(docs, norm_q, limit=max(50, top_k))
+    fuzzy = fuzzy_multi(index, norm_q, limit=max(50, top_k))
     if fuzzy:
         return fuzzy[:top_k]
 
     # 6) semantic
-    q_vec = model.encode([norm_q], convert_to_numpy=True)
-    hits = util.semantic_search(q_vec, vectors, top_k=top_k)[0]
-    return [docs[h["corpus_id"]] for h in hits]
+    vectors, model = _load_semantic()
+    q_vec = model.encode([norm_q], convert_to_numpy=True, normalize_embeddings=True)
+    cand = None  # row ids of a Hamming pre-rank subset; None scores every row
+    if simsimd is not None:
+        n = max(HAMMING_CANDIDATES, top_k)
+        if len(vectors) >= max(HAMMING_MIN_ROWS, n):
+            # 1-bit popcount pass over everything, int8 cosine only on the survivors
+            ham = np.asarray(simsimd.cdist(binarize(q_vec), _load_bin_vectors(),
+                                           metric="hamming", dtype="bin8")).ravel()
+            cand = np.sort(np.argpartition(ham, n - 1)[:n])
+        # full scans pass the mmap straight through; only a subset is copied out
+        rows = vectors if cand is None else vectors[cand]
+        # simsimd returns cosine *distance*; flip to similarity for ranking
+        scores = 1 - np.asarray(simsimd.cdist(quantize_i8(q_vec), rows, metric="cosine")).ravel()
+    else:
+        # rows are unit vectors rounded to int8 (x127), so a plain dot product
+        # ranks approximately like the cosine without any re-normalization
+        scores = vectors @ q_vec.reshape(-1)
+    k = min(top_k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    if cand is not None:
+        top = cand[top]
+    return [docs[i] for i in top]
 
 def _print_result(r: Dict[str, Any]):
     print(f"* {r['title']} — {r.get('ausfuehrung','')}".rstrip(" —"))